@@ -5,37 +5,150 @@ academic publication standard.
 """
 
 
-import numpy as np
-import sys
-
-#matplotlib.use('Agg')
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib import rcParams
-from cycler import cycler
-
 import os
-import re
+import pathlib
+import subprocess
+import tempfile
+import weakref
 
-try:
-    import commands   as comsub
-except:
-    import subprocess as comsub
-    
 import configparser
+import dataclasses
+import functools
+
+
+@functools.lru_cache(maxsize=1)
+def _get_config():
+    """Load the configuration containing the tex column- page- and line-widths.
+    Parsed on first use and cached thereafter.
+    """
+    config = configparser.ConfigParser(
+        allow_no_value=True
+    )
+    config.read( "config.ini" )
+    return config
 
 
-# load the configuration containing the tex column- page- and line-widths
-config = configparser.ConfigParser(
-    allow_no_value=True
-)
-config.read( "config.ini" )
+@dataclasses.dataclass(frozen=True)
+class JournalConf :
+    """Page dimensions (in tex points) and save suffix of a publication template.
+    """
+    colwidth: float
+    linewidth: float
+    height: float
+    savesuf: str
+
+
+@functools.lru_cache(maxsize=None)
+def _journal_conf(key):
+    """Read the configuration for a publication template once and cache it.
+    A key of None selects the DEFAULT configuration.
+    """
+    s = _get_config()["DEFAULT" if key is None else key.upper()]
+    return JournalConf(
+        colwidth=s.getfloat( "texcolumnwidth" ),
+        linewidth=s.getfloat( "texlinewidth" ),
+        height=s.getfloat( "texheight" ),
+        savesuf=s.get( "savesuf" ) or "",
+    )
 
 # list of all implemented templates
 astronomy_journal = ['mnras', 'apj', 'aa', 'iau']
 university_thesis = ['lmu']
 
 
+# golden ratio used for the default plot height
+_GOLDEN_RATIO = 2.0 / (1.0 + 5.0 ** 0.5)
+
+# conversion from tex pt to inch length measurements
+_INCHES_PER_POINT = 1.0 / 72.27
+
+# configure text and line widths
+_FONT_SIZE = 8
+_LINEWIDTH = 0.5
+
+# Plot settings for nice publication worthy plots, applied in one update
+_BASE_RC = {
+    'figure.subplot.top' : 0.95,
+
+    'font.size' : _FONT_SIZE,
+    'axes.labelsize' : _FONT_SIZE,
+    'axes.titlesize' : _FONT_SIZE,
+
+    'xtick.major.width' : _LINEWIDTH-0.1,
+    'xtick.minor.width' : _LINEWIDTH-0.1,
+    'ytick.major.width' : _LINEWIDTH-0.1,
+    'ytick.minor.width' : _LINEWIDTH-0.1,
+    'lines.linewidth' : _LINEWIDTH,
+    'grid.linewidth' : _LINEWIDTH,
+
+    'xtick.minor.visible' : True,
+    'ytick.minor.visible' : True,
+
+    'xtick.bottom' : True,
+    'xtick.top' : True,
+
+    'ytick.left' : True,
+    'ytick.right' : True,
+
+    'xtick.direction' : "in",
+    'ytick.direction' : "in",
+
+    'errorbar.capsize' : 4,
+
+    'legend.fontsize' : _FONT_SIZE,
+    'legend.framealpha' : 0.,
+    'legend.edgecolor' : "w",
+
+    'xtick.labelsize' : _FONT_SIZE - 1,
+    'ytick.labelsize' : _FONT_SIZE - 1,
+
+    'font.family' : 'sans-serif',   # default
+    'text.usetex' : True,
+    'text.latex.preamble' : r'\usepackage{underscore}',
+
+    'contour.negative_linestyle' : 'solid',
+
+    # determine the new cycling order (string form is parsed by matplotlib,
+    # so cycler need not be imported here)
+    'axes.prop_cycle' : "cycler(color='brckmgy')",
+}
+
+# Plot border settings depending on the number of columns spanned
+_NCOLS_RC = {
+    1 : {
+        'figure.subplot.bottom' : 0.2,
+        'figure.subplot.left' : 0.16,
+        'figure.subplot.right' : 0.84,
+    },
+    2 : {
+        'figure.subplot.bottom' : 0.1,
+        'figure.subplot.left' : 0.08,
+        'figure.subplot.right' : 0.92,
+    },
+    None : {
+        'figure.subplot.bottom' : 0.2,
+        'figure.subplot.left' : 0.16,
+        'figure.subplot.right' : 0.84,
+    },
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _build_rc(ncols):
+    """Combined rc settings for a figure spanning ncols columns.
+    The returned dict is shared between calls and must not be modified.
+    """
+    return {**_BASE_RC, **_NCOLS_RC[ncols]}
+
+
+# qualfigs that have not been saved yet (as weak references, oldest first)
+# and the rcParams values their settings replaced. Figures may be saved in
+# any order, so on each save the rcParams are rebuilt from the originals
+# plus the settings of the figures that are still live.
+_live_qualfigs = []
+_rc_originals = {}
+
+
 
 
 
@@ -71,31 +184,30 @@ class qualfig(object) :
             if key not in permitted_keys:
                 raise KeyError("Selected key '"+"{}".format(key)+"' is not yet implemented...\n"+\
                                "Permitted keys are:\n{}".format(permitted_keys))
-            else :
-                plot_conf = config.__getitem__(key.upper())
                 
         else :
             if self.__verbose : 
                 print("Using the DEFAULT configuration...")
         
+        jc = _journal_conf(key)
         
         # load the save file suffix
-        self.__save_suffix = plot_conf.get( "savesuf" ) + ".pdf"
+        self.__save_suffix = jc.savesuf + ".pdf"
         
         
         # define the plot width
         if ncols == 1 :
             # plot should span one column
-            self.__width = plot_conf.getfloat( "texcolumnwidth" )
+            self.__width = jc.colwidth
             
         elif ncols == 2 :
             # plot should span both columns
-            self.__width = plot_conf.getinfloat( "texlinewidth" )
+            self.__width = jc.linewidth
             
         elif ncols is None:
             # plot should span a defined fraction of the full-page width
             if wf is not None :
-                self.__width = plot_conf.getfloat( "texlinewidth" ) * wf
+                self.__width = jc.linewidth * wf
             else :
                 raise ValueError("Please define the full-page width fraction you wish to use...")
         
@@ -104,15 +216,14 @@ class qualfig(object) :
             
             
         # define the plot height
-        max_height = plot_conf.getfloat( "texheight" )
+        max_height = jc.height
         if hf is None :
             # if height fraction isn't specified provide space for a caption
             self.__height = 0.80 * max_height
             
         elif hf=="gr" :
             # make the plot have golden ratio size
-            golden_ratio = 2.0 / (1.0 + np.sqrt(5.0))
-            self.__height = self.__width * golden_ratio
+            self.__height = self.__width * _GOLDEN_RATIO
             
         else :
             # else we set the height as a fraction of the plot width
@@ -123,89 +234,71 @@ class qualfig(object) :
                              "\n"+\
                              "Maximum possible value of hf is {:4.3f}".format(max_height/self.__width))
             
+        # defer the (slow) matplotlib import until a figure is actually requested
+        #matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from matplotlib import rcParams
+
+        self._plt = plt
+        self._rcParams = rcParams
         
         # convert width and height to matplotlib inch units
-        self.__inches_to_points = 72.27# define the conversion from inch to pt length measurements
+        w_in = self.__width * _INCHES_PER_POINT
+        h_in = self.__height * _INCHES_PER_POINT
         
         if self.__verbose :
             print("Figure size in inches: {w} x {h}".format(
-                w=self.__width / self.__inches_to_points,
-                h=self.__height / self.__inches_to_points
+                w=w_in,
+                h=h_in
             ))
 
         
         # Plot border settings for nice publication worthy plots
-        rcParams['figure.subplot.top'] = 0.95
-        
-        if ncols==1:
-            rcParams['figure.subplot.bottom'] = 0.2
-            rcParams['figure.subplot.left'] = 0.16
-            rcParams['figure.subplot.right'] = 0.84
-
-        elif ncols==2 :
-            rcParams['figure.subplot.bottom'] = 0.1
-            rcParams['figure.subplot.left'] = 0.08
-            rcParams['figure.subplot.right'] = 0.92
-            
-        else :
+        if ncols is None :
             print("Using a fractional plot width will likely require manually setting the plot borders")
-            rcParams['figure.subplot.bottom'] = 0.2
-            rcParams['figure.subplot.left'] = 0.16
-            rcParams['figure.subplot.right'] = 0.84
-
-        
-
-        rcParams['figure.figsize'] = (
-            self.__width / self.__inches_to_points, 
-            self.__height / self.__inches_to_points
-        )
-        
-        # configure text and line widths
-        font_size =  8
-        linewidth = 0.5
 
-        rcParams['font.size'] = font_size
-        rcParams['axes.labelsize'] = font_size
-        rcParams['axes.titlesize'] = font_size
+        # the settings are undone once the figure is saved, rather than
+        # leaking into subsequent figures
+        self._rc = {}
+        _live_qualfigs.append(weakref.ref(self))
+        self._set_rc({
+            **_build_rc(ncols),
+            'figure.figsize' : (w_in, h_in),
+        })
 
-        rcParams['xtick.major.width'] = linewidth-0.1
-        rcParams['xtick.minor.width'] = linewidth-0.1
-        rcParams['ytick.major.width'] = linewidth-0.1
-        rcParams['ytick.minor.width'] = linewidth-0.1
-        rcParams["lines.linewidth"] = linewidth 
-        rcParams["grid.linewidth"]  = linewidth 
-
-        rcParams['xtick.minor.visible'] = True
-        rcParams['ytick.minor.visible'] = True
-
-        rcParams["xtick.bottom"]=True
-        rcParams["xtick.top"]=True
-
-        rcParams["ytick.left"]=True
-        rcParams["ytick.right"]=True
+        self.__dpi=1000
 
-        rcParams["xtick.direction"]="in"
-        rcParams["ytick.direction"]="in"
 
-        rcParams["errorbar.capsize"] = 4
+    def _set_rc(self, rc) :
+        """Apply rc settings for this figure, remembering the values they replace
+        """
+        if self._rc is None :
+            raise RuntimeError("The figure has already been saved, its settings can no longer be changed...")
 
-        rcParams['legend.fontsize'] = font_size
-        rcParams['legend.framealpha'] = 0.
-        rcParams['legend.edgecolor'] = "w"
+        for k in rc :
+            _rc_originals.setdefault(k, self._rcParams[k])
+        self._rc.update(rc)
+        self._rcParams.update(rc)
 
-        rcParams['xtick.labelsize'] = font_size - 1
-        rcParams['ytick.labelsize'] = font_size - 1
 
-        rcParams['font.family'] = 'sans-serif'   # default
-        rcParams['text.usetex'] = True
-        plt.rc('text.latex', preamble=r'\usepackage{underscore}')
+    def _restore_rc(self) :
+        """Undo the rc settings of this figure while keeping those of any
+        other qualfig that has not been saved yet
+        """
+        if self._rc is None :
+            return
+        self._rc = None
 
-        rcParams['contour.negative_linestyle'] = 'solid'
+        live = [ref() for ref in _live_qualfigs]
+        live = [qf for qf in live if qf is not None and qf is not self]
+        _live_qualfigs[:] = [weakref.ref(qf) for qf in live]
 
-        # determine the new cycling order
-        rcParams['axes.prop_cycle'] = cycler(color='brckmgy')
+        self._rcParams.update(_rc_originals)
+        for qf in live :
+            self._rcParams.update(qf._rc)
 
-        self.__dpi=1000
+        if not live :
+            _rc_originals.clear()
 
         
     def is_colorbar_axis(self,AXIS) :
@@ -220,69 +313,93 @@ class qualfig(object) :
 
     def set_label_spaces(self,side=None,bottom=None,top=None,left=None,right=None):
         """Function to customise the plot whitespace borders 
-        
+        Must be called before the figure is saved.
         """
         
         # check for conflicting instructions
-        side_is_not_None = side is not None
-        left_is_not_None = left is not None
-        right_is_not_None = right is not None
-        
-        if side_is_not_None and ( left_is_not_None or right_is_not_None ) :
+        if side is not None and ( left is not None or right is not None ) :
             print("WARNING: Defaulting to the setting for --side--")
 
-        if side_is_not_None  :
-            rcParams['figure.subplot.left'] = side
-            rcParams['figure.subplot.right'] = 1-side
+        rc = {}
+        if side is not None :
+            rc['figure.subplot.left'] = side
+            rc['figure.subplot.right'] = 1-side
             
         else: 
 
-            if left_is_not_None :
-                rcParams['figure.subplot.left'] = left
+            if left is not None :
+                rc['figure.subplot.left'] = left
 
-            if right_is_not_None :
-                rcParams['figure.subplot.right'] = 1-right
+            if right is not None :
+                rc['figure.subplot.right'] = 1-right
 
         if bottom is not None :
-            rcParams['figure.subplot.bottom'] = bottom
+            rc['figure.subplot.bottom'] = bottom
 
         if top is not None :
-            rcParams['figure.subplot.top'] = 1.-top
+            rc['figure.subplot.top'] = 1.-top
+
+        self._set_rc(rc)
 
 
     def _crop_figure(self,fname,dpi) :
         """
         function to crop figures correctly
         work initially in pdf format but can then convert to other file formats
+
+        the crop keeps the full figure width and only trims the vertical
+        whitespace, so it is computed in-process from the tight bounding box
+        """
+        from matplotlib.transforms import Bbox
+
+        fig = self._plt.gcf()
+        x0, y0, x1, y1 = fig.get_tightbbox().extents
+        if self.__verbose :
+            print(x0, y0, x1, y1)
+        # only the vertical extent is taken from the bbox, the width is fixed
+        crop = Bbox.from_extents(0, y0, fig.get_figwidth(), y1)
+        self._plt.savefig(fname, dpi=dpi, bbox_inches=crop)
+
+    def save(self, fname, extension="pdf", dpi=None, tight=False ):
+        """
+        :param fname: Name of the output file, the template save suffix is appended
+        :param extension: Output format, "pdf" or "eps". Default: "pdf"
+        :param dpi: Resolution of rasterised elements. Default: 1000
+        :param tight: Crop to the tight bounding box instead of keeping the full
+                      figure (i.e. column) width and only trimming vertically.
+                      Default: False
         """
-        name = 'dum.pdf'
-        plt.savefig(name,dpi=dpi)
-        command = 'gs -sDEVICE=bbox -dNOPAUSE -dBATCH %s'%name
-        r = comsub.getoutput(command).split()
-        bbox = [float(a) for a in r[-4:]]
-        print(bbox)
-        os.system("pdfcrop %s %s --bbox \" %.6f %.6f %.6f %.6f \" " % (name, fname,0, bbox[1], self.__width, bbox[3]))
-        command = 'rm %s'%(name)
-        os.system(command)
-
-    def save(self, fname, extension="pdf", dpi=None ):
 
         if dpi is None :
             dpi=self.__dpi
                   
         # strip the .pdf extension if it is there
-        if fname[-4:] == ".pdf":
-            fname = fname[:-4]
+        fname = fname.removesuffix(".pdf")
                   
         # now construct the save name we will use...
-        savename = fname+self.__save_suffix
-                  
-        # initially crop the figure
-        self._crop_figure(savename,dpi=dpi)
-                  
+        savename = pathlib.Path(fname+self.__save_suffix)
+
         if extension=="eps":
-            # now convert to eps
-            command = 'pdftops -eps %s'%(savename)
-            os.system(command)
-            command = 'rm %s'%(savename)
-            os.system(command)
+            # the intermediate pdf goes to a unique scratch file so that
+            # concurrent saves don't collide
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tf :
+                pdfname = tf.name
+        else :
+            pdfname = savename
+
+        try :
+            # initially crop the figure
+            if tight :
+                self._plt.savefig(pdfname, dpi=dpi, bbox_inches='tight', pad_inches=0.01)
+            else :
+                self._crop_figure(pdfname,dpi=dpi)
+
+            if extension=="eps":
+                # now convert to eps
+                subprocess.run(["pdftops", "-eps", pdfname, savename.with_suffix(".eps")], check=True)
+        finally :
+            if extension=="eps":
+                os.unlink(pdfname)
+
+            # the figure's settings are undone even if the save failed
+            self._restore_rc()